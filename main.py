@@ -1,22 +1,143 @@
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
 import pandas as pd
 import streamlit as st
-import plotly.express as px
 
 # Ref: https://towardsdatascience.com/streamlit-101-an-in-depth-introduction-fc8aad9492f2
 
-# disable warnings
-st.set_option('deprecation.showPyplotGlobalUse', False)
-
 # fetch Airbnb data
-
-
-@st.cache  # this will download the data and cache it for later use
+DATA_URL = "http://data.insideairbnb.com/united-states/ny/new-york-city/2021-09-01/visualisations/listings.csv"
+DATA_PATH = Path(__file__).with_name("listings.parquet")
+# only the columns the app actually uses
+USED_COLS = ["name", "host_id", "host_name", "neighbourhood_group", "neighbourhood", "latitude", "longitude",
+             "room_type", "price", "minimum_nights", "number_of_reviews", "availability_365"]
+# narrow dtypes keep the frame small, low cardinality strings become categories
+DTYPES = {"host_id": "int32", "latitude": "float32", "longitude": "float32", "price": "float32",
+          "minimum_nights": "int16", "number_of_reviews": "int32", "availability_365": "int16",
+          "room_type": "category", "neighbourhood_group": "category", "neighbourhood": "category",
+          "host_name": "category"}
+
+
+# this will download the data once and keep it as parquet on disk, the loaded frame is
+# shared across reruns and sessions so it never goes through the cache hasher
+@st.cache_resource(show_spinner=False)
 def get_data():
-    url = "http://data.insideairbnb.com/united-states/ny/new-york-city/2021-09-01/visualisations/listings.csv"
-    return pd.read_csv(url)
+    if not DATA_PATH.exists():
+        # only needed for the first download, pyarrow parses the csv multithreaded straight into typed columns
+        from urllib.request import urlopen
+
+        import pyarrow as pa
+        from pyarrow import csv
+
+        column_types = {c: pa.dictionary(pa.int32(), pa.string()) if t == "category" else pa.from_numpy_dtype(np.dtype(t))
+                        for c, t in DTYPES.items()}
+        with urlopen(DATA_URL) as f:
+            # free text columns like name can hold quoted line breaks
+            tbl = csv.read_csv(f, parse_options=csv.ParseOptions(newlines_in_values=True),
+                               convert_options=csv.ConvertOptions(include_columns=USED_COLS,
+                                                                  column_types=column_types))
+        # write next to the final file and swap it in, so an interrupted run never leaves a partial file behind
+        tmp_path = DATA_PATH.with_suffix(".parquet.tmp")
+        tbl.to_pandas().to_parquet(tmp_path, compression="snappy")
+        os.replace(tmp_path, DATA_PATH)
+    # enforce the schema on read too, a no-op when the file already has it
+    return pd.read_parquet(DATA_PATH, columns=USED_COLS).astype(DTYPES)
+
+
+# the columns the filters work on as plain arrays, extracted once and shared like the frame
+@st.cache_resource
+def get_arrays():
+    df = get_data()
+    ng = df["neighbourhood_group"].cat
+    return SimpleNamespace(price=df["price"].to_numpy(),
+                           ng_codes=ng.codes.to_numpy(),
+                           ng_code={name: code for code, name in enumerate(ng.categories)},
+                           av=df["availability_365"].to_numpy(),
+                           host_id=df["host_id"].to_numpy())
 
 
 df = get_data()
+arrays = get_arrays()
+
+
+# derived frames that only depend on the data, cached so reruns skip recomputing them.
+# they take the frame from get_data() rather than as an argument so it is never hashed
+
+
+# built once per session through memo_output below
+def expensive_map_points():
+    df = get_data()
+    m = get_arrays().price >= 800
+    return df.loc[m, ["latitude", "longitude"]].dropna(how="any").astype(np.float32)
+
+
+@st.cache_data
+def avg_price_by_room():
+    df = get_data()
+    return df.groupby("room_type", observed=True, sort=False)["price"].mean()\
+        .sort_values(ascending=False).round(2).rename("avg_price").reset_index()
+
+
+@st.cache_data
+def top_hosts(k=2):
+    # count listings per host and pick the k largest without sorting every host
+    ids, counts = np.unique(get_arrays().host_id, return_counts=True)
+    idx = np.argpartition(-counts, k - 1)[:k]
+    idx = idx[np.argsort(-counts[idx])]
+    return ids[idx], counts[idx]
+
+
+@st.cache_data
+def host_listings(host_id):
+    df = get_data()
+    return df[get_arrays().host_id == host_id]
+
+
+@st.cache_resource
+def by_reviews():
+    df = get_data()
+    # sorted once so a review count range is a contiguous slice
+    return df.sort_values("number_of_reviews", kind="stable").reset_index(drop=True)
+
+
+@st.cache_data
+def price_slider_bounds():
+    p = get_arrays().price
+    return float(p.min()), float(np.minimum(p, 1000.).max())
+
+
+@st.cache_data
+def neighborhoods():
+    df = get_data()
+    return tuple(df.neighbourhood_group.cat.categories)
+
+
+# built once per session through memo_output below
+def avail_bar_fig():
+    from matplotlib.figure import Figure  # only needed to draw this chart
+
+    df = get_data()
+    # a plain Figure is not tracked by pyplot, so figures kept in the session are never left open
+    fig = Figure()
+    ax = fig.subplots()
+    df.query("availability_365>0").groupby("neighbourhood_group", observed=True)\
+        .availability_365.mean().plot.bar(rot=0, ax=ax)
+    ax.set(title="Average availability by neighborhood group",
+           xlabel="Neighborhood group", ylabel="Avg. availability (in no. of days)")
+    return fig
+
+
+# keep built outputs in the session and only rebuild one when its inputs change,
+# so a widget change doesn't redo the unrelated outputs on the rerun
+def memo_output(key, inputs, build):
+    h = hash(inputs)
+    if st.session_state.get(key + "_h") != h:
+        st.session_state[key] = build()
+        st.session_state[key + "_h"] = h
+    return st.session_state[key]
 
 
 # Page Title and Subtitle
@@ -37,12 +158,23 @@ st.dataframe(df.head())
 # Additional Info
 st.header("Caching our data")
 st.markdown(
-    "Streamlit has a handy decorator [`st.cache`](https://streamlit.io/docs/api.html#optimize-performance) to enable data caching.")
+    "Streamlit has handy decorators [`st.cache_data`](https://docs.streamlit.io/library/api-reference/performance/st.cache_data) \
+and [`st.cache_resource`](https://docs.streamlit.io/library/api-reference/performance/st.cache_resource) to enable data caching.")
 st.code("""
-@st.cache
+@st.cache_resource(show_spinner=False)
 def get_data():
-    url = "http://data.insideairbnb.com/united-states/ny/new-york-city/2021-09-01/visualisations/listings.csv"
-    return pd.read_csv(url)
+    if not DATA_PATH.exists():
+        with urlopen(DATA_URL) as f:
+            # free text columns like name can hold quoted line breaks
+            tbl = csv.read_csv(f, parse_options=csv.ParseOptions(newlines_in_values=True),
+                               convert_options=csv.ConvertOptions(include_columns=USED_COLS,
+                                                                  column_types=column_types))
+        # write next to the final file and swap it in, so an interrupted run never leaves a partial file behind
+        tmp_path = DATA_PATH.with_suffix(".parquet.tmp")
+        tbl.to_pandas().to_parquet(tmp_path, compression="snappy")
+        os.replace(tmp_path, DATA_PATH)
+    # enforce the schema on read too, a no-op when the file already has it
+    return pd.read_parquet(DATA_PATH, columns=USED_COLS).astype(DTYPES)
 """, language="python")
 st.markdown(
     "_To display a code block, pass in the string to display as code to [`st.code`](https://streamlit.io/docs/api.html#streamlit.code)_.")
@@ -57,41 +189,44 @@ st.subheader("On a map")
 st.markdown(
     "The following map shows the top 1% most expensive Airbnbs priced at $800 and above.")
 # fetch price >=800 from the df in and display latitude and longitude, drop null values, display in a map
-st.map(df.query("price>=800")[["latitude", "longitude"]].dropna(how="any"))
+st.map(memo_output("map", (), expensive_map_points))
 
 
 # Display most expensive properties in a table
 st.subheader("In a table")
 st.markdown("Following are the top five most expensive properties.")
-# fetch price>=800, sort prices descending and display the head in a table
-st.write(df.query("price>=800").sort_values("price", ascending=False).head())
+# fetch price>=800, pick the five highest prices and display them in a table
+st.write(df[arrays.price >= 800].nlargest(5, "price"))
 
 
 # Display Avg price by room type in a table
 st.header("Average price by room type")
 st.write("You can also display static tables. As opposed to a data frame, with a static table you cannot sort by clicking a column header.")
-# find price mean of room_type and sort descending
-st.table(df.groupby("room_type").price.mean().reset_index()
-         .round(2).sort_values("price", ascending=False)
-         .assign(avg_price=lambda x: x.pop("price").apply(lambda y: "%.2f" % y)))
+# find price mean of room_type and sort descending, two decimals are applied when rendering
+st.table(avg_price_by_room().style.format({"avg_price": "{:.2f}"}))
 
 
 # Which hosts have the most properties listed?
 st.header("Which host has the most properties listed?")
-listingcounts = df.host_id.value_counts()
-top_host_1 = df.query('host_id==@listingcounts.index[0]')
-top_host_2 = df.query('host_id==@listingcounts.index[1]')
-st.write(f"""**{top_host_1.iloc[0].host_name}** is at the top with {listingcounts.iloc[0]} property listings.
-**{top_host_2.iloc[1].host_name}** is second with {listingcounts.iloc[1]} listings. Following are randomly chosen
+top_ids, top_counts = top_hosts()
+top_host_1 = host_listings(top_ids[0])
+top_host_2 = host_listings(top_ids[1])
+st.write(f"""**{top_host_1.iloc[0].host_name}** is at the top with {top_counts[0]} property listings.
+**{top_host_2.iloc[1].host_name}** is second with {top_counts[1]} listings. Following are randomly chosen
 listings from the two displayed as JSON using [`st.json`](https://streamlit.io/docs/api.html#streamlit.json).""")
 
+# pick two random listings of a host as records
+SAMPLE_COLS = ["name", "neighbourhood", "room_type", "minimum_nights", "price"]
+
+
+def two_sample(sub):
+    idx = np.random.default_rng(4).choice(len(sub), 2, replace=False)
+    return sub.iloc[idx][SAMPLE_COLS].to_dict(orient="records")
+
+
 # disply json
-st.json({top_host_1.iloc[0].host_name: top_host_1
-         [["name", "neighbourhood", "room_type", "minimum_nights", "price"]]
-         .sample(2, random_state=4).to_dict(orient="records"),
-         top_host_2.iloc[0].host_name: top_host_2
-         [["name", "neighbourhood", "room_type", "minimum_nights", "price"]]
-         .sample(2, random_state=4).to_dict(orient="records")})
+st.json(memo_output("host_json", tuple(top_ids), lambda: {
+    host.iloc[0].host_name: two_sample(host) for host in (top_host_1, top_host_2)}))
 
 
 # What is the distribution of property price?
@@ -100,13 +235,26 @@ st.header("What is the distribution of property price?")
 st.write("""Select a custom price range from the side bar to update the histogram below displayed as a Plotly chart using
 [`st.plotly_chart`](https://streamlit.io/docs/api.html#streamlit.plotly_chart).""")
 # slider with custom props that will affect the histogram
-values = st.sidebar.slider("Price range", float(df.price.min()), float(
-    df.price.clip(upper=1000.).max()), (50., 300.))
-f = px.histogram(df.query(
-    f"price.between{values}"), x="price", nbins=15, title="Price distribution")
-f.update_xaxes(title="Price")
-f.update_yaxes(title="No. of listings")
-st.plotly_chart(f)
+lo_bound, hi_bound = price_slider_bounds()
+values = st.sidebar.slider("Price range", lo_bound, hi_bound, (50., 300.))
+
+
+def build_hist(values):
+    import plotly.express as px  # only needed for the histogram
+
+    lo, hi = values
+    mask = (arrays.price >= lo) & (arrays.price <= hi)
+    # bin the prices here and only send the 15 bars to the browser
+    counts, edges = np.histogram(arrays.price[mask], bins=15, range=values)
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    f = px.bar(x=centers, y=counts, title="Price distribution")
+    f.update_layout(bargap=0)
+    f.update_xaxes(title="Price")
+    f.update_yaxes(title="No. of listings")
+    return f
+
+
+st.plotly_chart(memo_output("hist", values, lambda: build_hist(values)))
 
 
 # Distribution of availability in various neighborhoods
@@ -117,32 +265,56 @@ Unlike a data frame, if content overflows out of the section margin, \
 a static table does not automatically hide it inside a scrollable area. \
 Instead, the overflowing content remains visible.")
 # radio button for chosing the neighborhood
-neighborhood = st.radio("Neighborhood", df.neighbourhood_group.unique())
+neighborhood = st.radio("Neighborhood", neighborhoods())
 # checkbox for including expensive listings
 show_exp = st.checkbox("Include expensive listings")
-show_exp = " and price<200" if not show_exp else ""
 
 # function for displaying data based on the above options
 
 
-@st.cache
-def get_availability(show_exp, neighborhood):
-    return df.query(f"""neighbourhood_group==@neighborhood{show_exp}\
-        and availability_365>0""").availability_365.describe(
-        percentiles=[.1, .25, .5, .75, .9, .99]).to_frame().T
+# same statistics as pandas describe, computed from a histogram of the integer values.
+# availability is bounded to 0..365 days so the histogram is tiny and the quantiles stay exact
+QUANTILES = np.array([0., .1, .25, .5, .75, .9, .99, 1.])
+DESCRIBE_COLS = ["count", "mean", "std", "min", "10%", "25%", "50%", "75%", "90%", "99%", "max"]
+
+
+def describe_counts(counts, name):
+    n = counts.sum()
+    if n == 0:
+        row = [0] + [np.nan] * (len(DESCRIBE_COLS) - 1)
+    else:
+        values = np.arange(counts.size)
+        mean = (values * counts).sum() / n
+        std = np.sqrt(((values - mean) ** 2 * counts).sum() / (n - 1)) if n > 1 else np.nan
+        # value at sorted position k is the first one whose cumulative count exceeds k,
+        # interpolated linearly between neighbouring positions like np.quantile
+        cdf = np.cumsum(counts)
+        pos = QUANTILES * (n - 1)
+        lo = np.floor(pos)
+        v_lo = np.searchsorted(cdf, lo, side="right")
+        v_hi = np.searchsorted(cdf, np.minimum(lo + 1, n - 1), side="right")
+        row = [n, mean, std, *(v_lo + (pos - lo) * (v_hi - v_lo))]
+    return pd.DataFrame([row], columns=DESCRIBE_COLS, index=[name])
+
+
+# keyed only on the two widget values, the data itself never goes through the cache hasher
+@st.cache_data(max_entries=32)
+def get_availability(neighborhood, cheap_only):
+    a = get_arrays()
+    m = (a.ng_codes == a.ng_code[neighborhood]) & (a.av > 0)
+    if cheap_only:
+        m &= a.price < 200
+    return describe_counts(np.bincount(a.av[m], minlength=366), "availability_365")
 
 
 # feed the fetched info into a table
-st.table(get_availability(show_exp, neighborhood))
+st.table(get_availability(str(neighborhood), not show_exp))
 st.write("At 169 days, Brooklyn has the lowest average availability. At 226, Staten Island has the highest average availability.\
     If we include expensive listings (price>=$200), the numbers are 171 and 230 respectively.")
 st.markdown(
     "_**Note:** There are 18431 records with `availability_365` 0 (zero), which I've ignored._")
 
-df.query("availability_365>0").groupby("neighbourhood_group")\
-    .availability_365.mean().plot.bar(rot=0).set(title="Average availability by neighborhood group",
-                                                 xlabel="Neighborhood group", ylabel="Avg. availability (in no. of days)")
-st.pyplot()
+st.pyplot(memo_output("avail_bar", (), avail_bar_fig))
 
 
 # Number of reviews
@@ -156,9 +328,13 @@ maximum = st.sidebar.number_input("Maximum", min_value=0, value=5)
 if minimum > maximum:
     st.error("Please enter a valid range")
 else:
-    # do the query
-    df.query("@minimum<=number_of_reviews<=@maximum").sort_values("number_of_reviews", ascending=False)\
-        .head(50)[["name", "number_of_reviews", "neighbourhood", "host_name", "room_type", "price"]]
+    # binary search the presorted counts for the range and take the 50 with the most reviews
+    dfr = by_reviews()
+    nr = dfr["number_of_reviews"].to_numpy()
+    lo_idx = np.searchsorted(nr, minimum, side="left")
+    hi_idx = np.searchsorted(nr, maximum, side="right")
+    dfr.iloc[max(lo_idx, hi_idx - 50):hi_idx][::-1]\
+        [["name", "number_of_reviews", "neighbourhood", "host_name", "room_type", "price"]]
 
 st.write("486 is the highest number of reviews and two properties have it. Both are in the East Elmhurst \
     neighborhood and are private rooms with prices $65 and $45. \